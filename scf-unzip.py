@@ -4,7 +4,7 @@ Tencent SCF COS Unzipper
 
 Purpose:
 - Serverless function that listens for COS PutObject events containing .zip files
-- Downloads the zip to /tmp, safely extracts entries, and uploads extracted files back to COS
+- Downloads the zip into memory (or /tmp when large), safely extracts entries, and uploads extracted files back to COS
 - Output layout: OUTPUT_PREFIX/<zip-base-name-without-ext>/...
 
 Key behaviors:
@@ -12,7 +12,7 @@ Key behaviors:
 - Ignores folder-marker events and output prefix files to prevent infinite loops
 - Prevents Zip Slip: rejects absolute paths and parent directory traversal
 - Robust directory detection via ZipInfo.is_dir() and external_attr mode bits
-- Parallel uploads using ThreadPoolExecutor; MAX_WORKERS configurable via env
+- Parallel downloads and uploads on one shared ThreadPoolExecutor; MAX_WORKERS configurable via env
 - Content types assigned with Python mimetypes
 - Recursively processes nested zip files up to MAX_RECURSION_DEPTH levels
 - Extracts zip contents but does NOT upload the zip files themselves
@@ -24,29 +24,45 @@ Configuration via environment variables:
 - OUTPUT_PREFIX: Prefix to write extracted files (e.g., "unzipper-output/")
 - REGION or TENCENTCLOUD_REGION: COS region (default "ap-guangzhou")
 - TENCENTCLOUD_SECRETID/SECRETKEY/SESSIONTOKEN: Credentials injected by SCF role, or use SECRETID/SECRETKEY/SESSIONTOKEN
-- MAX_WORKERS: Optional, number of parallel uploads (default 16)
+- MAX_WORKERS: Optional, number of parallel uploads (default 4 per available vCPU, clamped to 4..32)
 - MAX_RECURSION_DEPTH: Maximum depth for recursive zip processing (default 10)
+- DOWNLOAD_PART_SIZE: Optional, size in bytes of each parallel ranged GET for the source zip (default 16MB)
+- IN_MEMORY_ZIP_MAX_SIZE: Optional, source zips up to this many bytes are kept in memory instead of /tmp (default 128MB)
+- NESTED_ZIP_MEMORY_MAX: Optional, nested zips waiting to be extracted are kept in memory up to this many bytes in total, the rest go to /tmp (default 64MB)
+- MULTIPART_THRESHOLD: Optional, files larger than this many bytes are uploaded with multipart upload (default 8MB)
+- MULTIPART_PART_SIZE: Optional, multipart part size in MB (default 8)
+- DEDUPE_IDENTICAL_FILES: Optional, set to "1" to copy files with the same CRC-32 and size server-side instead of re-uploading them (default off)
+- DISABLE_GC: Optional, set to "1" to pause Python's cyclic GC while extracting (default off)
+- PACK_SMALL_FILES_UNDER: Optional, pack files smaller than this many bytes into one "<prefix>_small.tar" per zip instead of uploading them individually (default 0, disabled)
 
 Returns:
-- On success: {"status":"ok","bucket":<bucket>,"source_key":<zip key>,"output_prefix":<dest prefix>,"files_uploaded":<count>,"nested_zips_processed":<count>,"max_depth_reached":<bool>}
+- On success: {"status":"ok","bucket":<bucket>,"source_key":<zip key>,"output_prefix":<dest prefix>,"files_uploaded":<count>,"files_packed":<count>,"nested_zips_processed":<count>,"max_depth_reached":<bool>}
 - On ignore/error: structured reason and diagnostics (e.g., seen keys)
 """
 import os
 import io
+import gc
 import sys
+import re
 import json
+import time
+import zlib
+import struct
+import shutil
 import mimetypes
+import tarfile
+import tempfile
 import zipfile
 import posixpath
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from qcloud_cos import CosConfig, CosS3Client
+from typing import Optional, Union
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 # Environment variables expected:
 # COS_BUCKET: target COS bucket name
 # INPUT_PREFIX: folder (prefix) to listen for zip uploads, e.g., "uploads/"
 # OUTPUT_PREFIX: folder (prefix) to write extracted files, e.g., "extracted/"
-# MAX_WORKERS: optional, number of parallel uploads (default 16)
+# MAX_WORKERS: optional, number of parallel uploads (default derived from available vCPUs)
 
 REGION = os.getenv("TENCENTCLOUD_REGION") or os.getenv("REGION") or "ap-guangzhou"
 SECRET_ID = os.getenv("TENCENTCLOUD_SECRETID") or os.getenv("SECRETID")
@@ -56,8 +72,31 @@ SESSION_TOKEN = os.getenv("TENCENTCLOUD_SESSIONTOKEN") or os.getenv("SESSIONTOKE
 COS_BUCKET = os.getenv("COS_BUCKET", "")
 INPUT_PREFIX = os.getenv("INPUT_PREFIX", "uploads/")
 OUTPUT_PREFIX = os.getenv("OUTPUT_PREFIX", "extracted/")
-MAX_WORKERS = int(os.getenv("MAX_WORKERS", "16"))
+
+# SCF allocates vCPUs in proportion to function memory; size the I/O-bound
+# worker pool from what this instance actually gets
+try:
+    AVAILABLE_CPUS = len(os.sched_getaffinity(0))
+except AttributeError:
+    AVAILABLE_CPUS = os.cpu_count() or 1
+DEFAULT_WORKERS = max(4, min(32, AVAILABLE_CPUS * 4))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS") or DEFAULT_WORKERS)
 MAX_RECURSION_DEPTH = int(os.getenv("MAX_RECURSION_DEPTH", "10"))
+DOWNLOAD_PART_SIZE = int(os.getenv("DOWNLOAD_PART_SIZE", str(16 * 1024 * 1024)))
+DOWNLOAD_PART_ATTEMPTS = 3
+IN_MEMORY_ZIP_MAX_SIZE = int(os.getenv("IN_MEMORY_ZIP_MAX_SIZE", str(128 * 1024 * 1024)))
+NESTED_ZIP_MEMORY_MAX = int(os.getenv("NESTED_ZIP_MEMORY_MAX", str(64 * 1024 * 1024)))
+PACK_SMALL_FILES_UNDER = int(os.getenv("PACK_SMALL_FILES_UNDER", "0"))
+DISABLE_GC = os.getenv("DISABLE_GC", "0") == "1"
+MULTIPART_THRESHOLD = int(os.getenv("MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+MULTIPART_PART_SIZE = int(os.getenv("MULTIPART_PART_SIZE", "8"))  # MB
+MULTIPART_THREADS = 4  # parts in flight per object
+DEDUPE_IDENTICAL_FILES = os.getenv("DEDUPE_IDENTICAL_FILES", "0") == "1"
+COPY_OBJECT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+# Entries and nested zips up to this size are buffered in RAM; larger entries are
+# streamed and larger nested zips spill to /tmp
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
 
 # Ensure prefixes end with '/'
 if INPUT_PREFIX and not INPUT_PREFIX.endswith('/'):
@@ -68,60 +107,361 @@ if OUTPUT_PREFIX and not OUTPUT_PREFIX.endswith('/'):
 # Setup COS client; in SCF, credentials are provided via env vars or role
 _config_kwargs = {
     'Region': REGION,
+    # One HTTP connection per worker thread so TLS sessions are reused across uploads
+    'PoolConnections': MAX_WORKERS,
+    'PoolMaxSize': MAX_WORKERS,
 }
 if SECRET_ID and SECRET_KEY:
     _config_kwargs.update({'SecretId': SECRET_ID, 'SecretKey': SECRET_KEY})
 if SESSION_TOKEN:
     _config_kwargs.update({'Token': SESSION_TOKEN})
 
-cos_client = CosS3Client(CosConfig(**_config_kwargs))
+# The SDK import and client are deferred to _get_client() so ignored events
+# (folder markers, output prefix files) return without loading qcloud_cos
+cos_client = None
 
 
-def _is_safe_member(member_name: str) -> bool:
-    # Prevent Zip Slip: reject absolute paths and parent directory traversal
-    if member_name.startswith('/'):
-        return False
-    parts = member_name.split('/')
-    for p in parts:
-        if p == '..':
-            return False
-    return True
+def _get_client():
+    global cos_client
+    if cos_client is None:
+        from qcloud_cos import CosConfig, CosS3Client
+        cos_client = CosS3Client(CosConfig(**_config_kwargs))
+    return cos_client
+
+# One-time state built at cold start so warm invocations skip it entirely:
+# the shared worker pool (threads are only spawned on first use) and an
+# extension -> content type table built from the system mime.types files
+_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+print(f"Worker pool: MAX_WORKERS={MAX_WORKERS} (available vCPUs: {AVAILABLE_CPUS})")
+mimetypes.init()
+_EXT2CT: dict[str, str] = {ext.lower(): ct for ext, ct in mimetypes.types_map.items()}
+for _ext, _ct in (('.webp', 'image/webp'), ('.avif', 'image/avif'), ('.zst', 'application/zstd'),
+                  ('.wasm', 'application/wasm'), ('.mjs', 'text/javascript')):
+    _EXT2CT.setdefault(_ext, _ct)
 
 
-def _sanitize_member(member_name: str) -> str:
-    # Normalize to POSIX path and strip leading './'
-    p = posixpath.normpath(member_name)
-    if p.startswith('./'):
-        p = p[2:]
-    return p
+# Zip Slip: an absolute path or any ".." component
+_UNSAFE_RE = re.compile(r'(?:^/)|(?:^|/)\.\.(?:/|$)')
+# Empty or "." components that need posixpath.normpath to collapse
+_DENORMAL_RE = re.compile(r'//|(?:^|/)\.(?:/|$)')
+
+
+def _clean_member(member_name: str) -> Optional[str]:
+    """Return the normalized POSIX name of a zip entry, or None if it is unsafe.
+
+    Safety check and normalization share one pass: backslashes from Windows
+    zippers become '/', names with an absolute path or a '..' component are
+    rejected, and normpath only runs for the rare names containing '//' or '.'
+    components. Directory names keep their trailing '/'. Plain substring tests
+    run first, so typical names never reach either regex.
+    """
+    name = member_name.replace('\\', '/') if '\\' in member_name else member_name
+    if not name or name[:1] == '/' or ('..' in name and _UNSAFE_RE.search(name)):
+        return None
+    if ('//' in name or '/.' in name or name[:1] == '.') and _DENORMAL_RE.search(name):
+        name = posixpath.normpath(name)
+        if name == '.':
+            return None
+    return name
 
 
 def _content_type_for(name: str) -> str:
-    ctype, _ = mimetypes.guess_type(name)
-    return ctype or 'application/octet-stream'
+    # Last-suffix lookup only: "x.tar.gz" is typed by ".gz", not as a tar
+    i = name.rfind('.')
+    if i < 0:
+        return 'application/octet-stream'
+    return _EXT2CT.get(name[i:].lower(), 'application/octet-stream')
+
+
+def _download_part(bucket: str, key: str, write, lo: int, hi: int):
+    # Fetch bytes lo..hi (inclusive) and hand each chunk to write(chunk, offset)
+    resp = _get_client().get_object(Bucket=bucket, Key=key, Range=f"bytes={lo}-{hi}")
+    _drain_part(key, resp['Body'], write, lo, hi)
+
+
+def _drain_part(key: str, body, write, lo: int, hi: int):
+    offset = lo
+    while True:
+        chunk = body.read(1024 * 1024)
+        if not chunk:
+            break
+        write(chunk, offset)
+        offset += len(chunk)
+    if offset != hi + 1:
+        raise IOError(f"Short read for bytes {lo}-{hi} of {key}: got {offset - lo} bytes")
+
+
+def _download_ranges(bucket: str, key: str, size: int, write, executor: ThreadPoolExecutor, first=None):
+    """Fetch an object of known size with parallel ranged GETs.
+
+    The object is split into DOWNLOAD_PART_SIZE slices fetched on the shared
+    executor; every chunk is passed to write(chunk, offset), so the destination
+    must be pre-sized. When given, first is the response to an already issued
+    GET for the first slice, whose body is drained instead of fetched again.
+    A failed slice is retried up to DOWNLOAD_PART_ATTEMPTS times before the
+    download is aborted.
+    """
+    pending = {}
+    try:
+        for lo in range(0, size, DOWNLOAD_PART_SIZE):
+            hi = min(lo + DOWNLOAD_PART_SIZE, size) - 1
+            if lo == 0 and first is not None:
+                fut = executor.submit(_drain_part, key, first['Body'], write, lo, hi)
+            else:
+                fut = executor.submit(_download_part, bucket, key, write, lo, hi)
+            pending[fut] = (lo, hi, 1)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                lo, hi, attempt = pending.pop(fut)
+                try:
+                    fut.result()
+                except Exception as e:
+                    if attempt >= DOWNLOAD_PART_ATTEMPTS:
+                        raise
+                    print(f"Retrying bytes {lo}-{hi} of {key} (attempt {attempt}): {str(e)}")
+                    pending[executor.submit(_download_part, bucket, key, write, lo, hi)] = (lo, hi, attempt + 1)
+    finally:
+        # Never leave parts writing into a destination the caller is about to release
+        for fut in pending:
+            fut.cancel()
+        wait(pending)
+
+
+def _download_to_buffer(bucket: str, key: str, local_path: str, executor: ThreadPoolExecutor) -> Union[io.BytesIO, str]:
+    """Download the source zip, keeping it in memory when it is small enough.
+
+    The first slice is requested straight away and the object size is taken from
+    its Content-Range, so no separate HEAD request is needed. Objects up to
+    IN_MEMORY_ZIP_MAX_SIZE are downloaded into a pre-sized BytesIO and returned
+    as-is, so they never touch /tmp. Larger ones are written into a pre-sized
+    file at local_path, and the path is returned.
+    """
+    first = _get_client().get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{DOWNLOAD_PART_SIZE - 1}")
+    # Content-Range: bytes 0-<hi>/<size>
+    size = int(first['Content-Range'].rsplit('/', 1)[1])
+    if size <= IN_MEMORY_ZIP_MAX_SIZE:
+        buf = io.BytesIO()
+        if size:
+            # Grow the buffer once up front; parts are copied into place
+            buf.seek(size - 1)
+            buf.write(b'\0')
+            view = buf.getbuffer()
+
+            def write(chunk, offset):
+                view[offset:offset + len(chunk)] = chunk
+
+            try:
+                _download_ranges(bucket, key, size, write, executor, first)
+            finally:
+                view.release()
+        buf.seek(0)
+        return buf
+
+    fd = os.open(local_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        _download_ranges(bucket, key, size, lambda chunk, offset: os.pwrite(fd, chunk, offset), executor, first)
+    finally:
+        os.close(fd)
+    return local_path
 
 
-def _download_to_tmp(bucket: str, key: str, local_path: str):
-    resp = cos_client.get_object(Bucket=bucket, Key=key)
-    body = resp['Body']
-    with open(local_path, 'wb') as f:
-        # Stream in chunks to file
+def _upload_object(bucket: str, key: str, body: bytes, content_type: str):
+    _get_client().put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=body,
+        ContentLength=str(len(body)),
+        ContentType=content_type,
+    )
+
+
+def _upload_part(bucket: str, key: str, upload_id: str, number: int, data: bytes) -> dict:
+    rt = _get_client().upload_part(
+        Bucket=bucket, Key=key, Body=data, PartNumber=number, UploadId=upload_id
+    )
+    return {'PartNumber': number, 'ETag': rt['ETag']}
+
+
+def _finish_part(fut, args: tuple) -> dict:
+    # A part still queued behind other work is uploaded inline instead of waited
+    # on, so uploaders never block on the pool they run on.
+    if fut.cancel():
+        return _upload_part(*args)
+    return fut.result()
+
+
+def _upload_multipart(bucket: str, key: str, body, content_type: str, executor: ThreadPoolExecutor):
+    client = _get_client()
+    upload_id = client.create_multipart_upload(
+        Bucket=bucket, Key=key, ContentType=content_type
+    )['UploadId']
+    part_size = MULTIPART_PART_SIZE * 1024 * 1024
+    parts = []
+    in_flight = deque()
+    try:
+        number = 1
         while True:
-            chunk = body.read(1024 * 1024)
-            if not chunk:
+            # Free a slot before reading so at most MULTIPART_THREADS parts are buffered
+            if len(in_flight) >= MULTIPART_THREADS:
+                parts.append(_finish_part(*in_flight.popleft()))
+            data = body.read(part_size)
+            if not data:
                 break
-            f.write(chunk)
+            args = (bucket, key, upload_id, number, data)
+            in_flight.append((executor.submit(_upload_part, *args), args))
+            number += 1
+        while in_flight:
+            parts.append(_finish_part(*in_flight.popleft()))
+        client.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Part': parts}
+        )
+    except Exception:
+        for fut, _ in in_flight:
+            fut.cancel()
+        wait([fut for fut, _ in in_flight])
+        try:
+            client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        except Exception as e:
+            print(f"Error aborting multipart upload of {key}: {str(e)}")
+        raise
 
 
-def _upload_object(bucket: str, key: str, data: bytes, content_type: str):
-    cos_client.put_object(
+def _upload_object_smart(bucket: str, key: str, body, size: int, content_type: str,
+                         executor: ThreadPoolExecutor):
+    """Upload bytes or a readable stream, switching to multipart for large objects.
+
+    Objects above MULTIPART_THRESHOLD are read in MULTIPART_PART_SIZE MB parts
+    whose uploads run on executor (the same pool this runs on), at most
+    MULTIPART_THREADS per object at a time; this also lifts the 5GB single PUT
+    limit. If reading or uploading fails the multipart upload is aborted. The
+    rest are read into bytes and sent with a single put_object.
+    """
+    if size <= MULTIPART_THRESHOLD:
+        if not isinstance(body, (bytes, bytearray)):
+            # put_object cannot size a ZipExtFile, and requests would seek it to
+            # the end and back, inflating the entry twice
+            with body:
+                body = body.read(size)
+        _upload_object(bucket, key, body, content_type)
+        return
+    if isinstance(body, (bytes, bytearray)):
+        body = io.BytesIO(body)
+    try:
+        _upload_multipart(bucket, key, body, content_type, executor)
+    finally:
+        body.close()
+
+
+def _copy_or_upload(bucket: str, key: str, original: tuple, task: tuple, content_type: str):
+    """Copy an already uploaded identical file server-side, or run task if that failed.
+
+    original is the (key, future) of the first upload with the same identity. It
+    was submitted to the pool before this call, so it is already running or done.
+    The copy gets its own content_type, since duplicates may differ in extension.
+    """
+    source_key, source_fut = original
+    try:
+        source_fut.result()
+    except Exception:
+        # Canonical upload failed: upload this copy in full instead
+        func, *args = task
+        func(*args)
+        return
+    _close_streams(task)
+    _get_client().copy_object(
         Bucket=bucket,
         Key=key,
-        Body=data,
+        CopySource={'Bucket': bucket, 'Key': source_key, 'Region': REGION},
+        CopyStatus='Replaced',
         ContentType=content_type,
     )
 
 
+def _close_streams(task: tuple):
+    # Release entries opened for a task that will not run, so zf can close its file
+    for arg in task:
+        if isinstance(arg, zipfile.ZipExtFile):
+            arg.close()
+
+
+def _fast_extract(zf: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> bytes:
+    """Read a STORED or DEFLATED entry in one shot, bypassing ZipExtFile.
+
+    Same approach as pip's wheel extractor: seek to the local header, check its
+    name against the central directory as zipfile.open does, skip the extra
+    field, read compress_size bytes in a single call and, for DEFLATED entries,
+    inflate them in one call capped just past file_size, so a lying central
+    directory cannot make it inflate more than ZipExtFile would. STORED entries
+    are returned as read. Sizes and CRC come from the central directory, so
+    ZIP64 entries need no special handling. Only the raw read holds the archive
+    lock; inflation runs on the calling worker thread.
+    """
+    with zf._lock:
+        zf.fp.seek(zinfo.header_offset)
+        fheader = zf.fp.read(30)
+        if len(fheader) != 30 or fheader[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Bad local file header for {zinfo.filename!r}")
+        flags, = struct.unpack('<H', fheader[6:8])
+        name_len, extra_len = struct.unpack('<HH', fheader[26:30])
+        fname = zf.fp.read(name_len)
+        zf.fp.seek(extra_len, os.SEEK_CUR)
+        buf = zf.fp.read(zinfo.compress_size)
+    encoding = 'utf-8' if flags & 0x800 else getattr(zf, 'metadata_encoding', None) or 'cp437'
+    if fname.decode(encoding, 'replace') != zinfo.orig_filename:
+        raise zipfile.BadZipFile(
+            f"File name in directory {zinfo.orig_filename!r} and header {fname!r} differ."
+        )
+    if zinfo.compress_type == zipfile.ZIP_STORED:
+        data = buf
+    else:
+        inflater = zlib.decompressobj(-15)
+        data = inflater.decompress(buf, zinfo.file_size + 1)
+        if len(data) > zinfo.file_size or inflater.unconsumed_tail:
+            raise zipfile.BadZipFile(f"File {zinfo.filename!r} inflates past its declared size")
+    if len(data) != zinfo.file_size or zlib.crc32(data) != zinfo.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {zinfo.filename!r}")
+    return data
+
+
+def _can_fast_extract(member: zipfile.ZipInfo) -> bool:
+    # Plain STORED/DEFLATED entries small enough to hold in memory; encrypted
+    # entries (flag bit 0) and other compression methods go through zipfile
+    return (member.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+            and not member.flag_bits & 0x1
+            and member.file_size <= SPOOL_MAX_SIZE)
+
+
+def _upload_small_member(zf: zipfile.ZipFile, member: zipfile.ZipInfo, bucket: str, key: str, content_type: str,
+                         executor: ThreadPoolExecutor):
+    _upload_object_smart(bucket, key, _fast_extract(zf, member), member.file_size, content_type, executor)
+
+
+def _buffer_member(zf: zipfile.ZipFile, member: zipfile.ZipInfo) -> io.BytesIO:
+    # _fast_extract never inflates past file_size and BytesIO wraps the
+    # result without copying, so the nested zip is never reallocated
+    return io.BytesIO(_fast_extract(zf, member))
+
+
+def _spool_member(src, in_memory: bool):
+    # Runs on the worker pool so nested zips decompress alongside uploads.
+    # In-memory zips are read into a BytesIO (ZipExtFile stops at file_size),
+    # the rest go to disk. SpooledTemporaryFile is not used: on Python 3.9 it
+    # lacks seekable(), which zipfile needs to open entries.
+    if in_memory:
+        with src:
+            return io.BytesIO(src.read())
+    spool = tempfile.TemporaryFile(dir='/tmp')
+    try:
+        with src:
+            shutil.copyfileobj(src, spool, 1024 * 1024)
+    except Exception:
+        spool.close()
+        raise
+    return spool
+
+
 def _zipinfo_is_dir(member: zipfile.ZipInfo) -> bool:
     try:
         if member.is_dir():
@@ -135,112 +475,292 @@ def _zipinfo_is_dir(member: zipfile.ZipInfo) -> bool:
         return False
 
 
-def _extract_and_upload(zip_path: str, bucket: str, dest_prefix: str, max_depth: int = 10):
-    """Extract all non-directory entries from a local zip file and upload them to COS.
-    Recursively processes any zip files found within the archive.
+def _extract_zip(source, bucket: str, dest_prefix: str, executor: ThreadPoolExecutor, allow_nested: bool,
+                 canonical: dict, memory_budget: int):
+    """Extract and upload the entries of a single zip level.
 
-    Args:
-        zip_path: Absolute path to the downloaded zip in /tmp.
-        bucket: Full COS bucket name (e.g., "mybucket-123456789").
-        dest_prefix: Prefix in COS under which extracted files will be placed.
-        max_depth: Maximum recursion depth to prevent infinite loops (default: 10).
+    Nested zips are not descended into here: when allow_nested is set they are
+    buffered on the worker pool and returned for the caller's worklist,
+    otherwise they are only counted as skipped. Buffering counts against the
+    same in-flight cap as uploads; nested zips are held in memory while their
+    sizes fit in memory_budget bytes and SPOOL_MAX_SIZE, and spill to /tmp after.
 
-    Behavior:
-        - Skips unsafe paths to prevent Zip Slip.
-        - Uses robust directory detection to avoid uploading folder placeholders.
-        - Uploads files in parallel (MAX_WORKERS).
-        - Sets content type via mimetypes.
-        - Recursively processes nested zip files up to max_depth levels.
-        - Does NOT upload zip files themselves - only extracts and uploads their contents.
+    When PACK_SMALL_FILES_UNDER is set, files below that size are appended to a
+    tar archive instead, uploaded once as "<dest_prefix>_small.tar".
+
+    When DEDUPE_IDENTICAL_FILES is set, canonical maps (CRC-32, size) to the key
+    and upload future of the first file seen with that identity, across all
+    levels; later files with the same identity are server-side copies of it.
 
     Returns:
-        dict: Summary with counts of processed files and nested zips.
+        tuple: (files_uploaded, files_packed, nested_zips, nested_zips_skipped),
+        where each nested zip is a dict with its name, a future for its buffered
+        copy, its destination prefix and the bytes it holds in memory.
     """
-    if max_depth <= 0:
-        return {'files_uploaded': 0, 'nested_zips_processed': 0, 'max_depth_reached': True}
-    
-    tasks = []
+    pending = deque()
     nested_zips = []
+    nested_zips_skipped = 0
     files_uploaded = 0
+    files_packed = 0
+    tar = tar_spool = None
+    # Keys are built by plain concatenation in the hot loop, so hold the trailing '/'
+    if not dest_prefix.endswith('/'):
+        dest_prefix += '/'
     
-    with zipfile.ZipFile(zip_path, 'r') as zf:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    with zipfile.ZipFile(source, 'r') as zf:
+        try:
             for member in zf.infolist():
-                name = member.filename
-                if not _is_safe_member(name):
+                if len(pending) >= 2 * MAX_WORKERS:
+                    # Backpressure: wait for the oldest job, surfacing upload failures early
+                    _settle(*pending.popleft())
+                clean_name = _clean_member(member.filename)
+                if clean_name is None:
                     # Skip unsafe paths
                     continue
                 # Skip directory entries (some zippers omit trailing slash)
                 if _zipinfo_is_dir(member):
                     continue
-                clean_name = _sanitize_member(name)
                 if clean_name.endswith('/'):
                     # Directory entry: no upload needed
                     continue
-                
-                # Read entry data into memory
-                with zf.open(member, 'r') as src:
-                    data = src.read()
-                
-                dest_key = posixpath.join(dest_prefix, clean_name)
+            
+                dest_key = dest_prefix + clean_name
                 content_type = _content_type_for(clean_name)
-                
+            
                 # Check if this is a nested zip file
                 if clean_name.lower().endswith('.zip'):
-                    # Save nested zip for recursive processing, but don't upload the zip file itself
-                    nested_zip_path = f"/tmp/nested_{len(nested_zips)}_{posixpath.basename(clean_name)}"
+                    # Skip uploading the zip file - we only want the extracted contents
+                    if not allow_nested:
+                        nested_zips_skipped += 1
+                        continue
+                    # Buffer nested zip for the worklist
+                    in_memory = member.file_size <= min(memory_budget, SPOOL_MAX_SIZE)
+                    if in_memory:
+                        memory_budget -= member.file_size
+                    if in_memory and _can_fast_extract(member):
+                        spool = executor.submit(_buffer_member, zf, member)
+                    else:
+                        spool = executor.submit(_spool_member, zf.open(member, 'r'), in_memory)
+                    pending.append((spool, None))
                     nested_zips.append({
-                        'path': nested_zip_path,
-                        'data': data,
-                        'dest_prefix': posixpath.join(dest_prefix, clean_name[:-4])  # Remove .zip extension
+                        'name': clean_name,
+                        'spool': spool,
+                        'dest_prefix': dest_prefix + clean_name[:-4] + '/',  # Remove .zip extension
+                        'held': member.file_size if in_memory else 0,
                     })
-                    # Skip uploading the zip file - we only want the extracted contents
                     continue
-                
-                # Upload non-zip files only
-                tasks.append(executor.submit(_upload_object, bucket, dest_key, data, content_type))
+
+                if member.file_size < PACK_SMALL_FILES_UNDER:
+                    if tar is None:
+                        tar_spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir='/tmp')
+                        tar = tarfile.open(fileobj=tar_spool, mode='w')
+                    data = _fast_extract(zf, member) if _can_fast_extract(member) else zf.read(member)
+                    info = tarfile.TarInfo(clean_name)
+                    info.size = len(data)
+                    info.mtime = time.mktime(member.date_time + (0, 0, -1))
+                    tar.addfile(info, io.BytesIO(data))
+                    files_packed += 1
+                    continue
+            
+                # Upload non-zip files only: small entries are inflated in one shot,
+                # the rest are read through zipfile, in parts above MULTIPART_THRESHOLD
+                if _can_fast_extract(member):
+                    task = (_upload_small_member, zf, member, bucket, dest_key, content_type, executor)
+                else:
+                    src = zf.open(member, 'r')
+                    task = (_upload_object_smart, bucket, dest_key, src, member.file_size, content_type, executor)
+
+                # Duplicates are known from the central directory, before decompressing
+                ident = None
+                if DEDUPE_IDENTICAL_FILES and 0 < member.file_size <= COPY_OBJECT_MAX_SIZE:
+                    ident = (member.CRC, member.file_size)
+                original = canonical.get(ident) if ident else None
+                if original is not None:
+                    fut = executor.submit(_copy_or_upload, bucket, dest_key, original, task, content_type)
+                else:
+                    fut = executor.submit(*task)
+                    if ident:
+                        canonical[ident] = (dest_key, fut)
+                pending.append((fut, task))
                 files_uploaded += 1
 
-            # Wait for uploads to complete
-            for fut in as_completed(tasks):
-                # Propagate any exceptions
-                fut.result()
+            if tar is not None:
+                tar.close()
+                size = tar_spool.tell()
+                tar_spool.seek(0)
+                # _upload_object_smart closes the spool once uploaded
+                spool, tar_spool = tar_spool, None
+                task = (
+                    _upload_object_smart, bucket, dest_prefix[:-1] + '_small.tar', spool, size, 'application/x-tar',
+                    executor,
+                )
+                pending.append((executor.submit(*task), task))
+                files_uploaded += 1
 
-    # Process nested zip files recursively
-    nested_zips_processed = 0
-    for nested_zip in nested_zips:
-        try:
-            # Write nested zip data to temp file
-            with open(nested_zip['path'], 'wb') as f:
-                f.write(nested_zip['data'])
-            
-            # Recursively extract nested zip
-            nested_result = _extract_and_upload(
-                nested_zip['path'], 
-                bucket, 
-                nested_zip['dest_prefix'], 
-                max_depth - 1
-            )
-            nested_zips_processed += 1 + nested_result.get('nested_zips_processed', 0)
-            files_uploaded += nested_result.get('files_uploaded', 0)
-            
-        except Exception as e:
-            # Log error but continue processing other nested zips
-            print(f"Error processing nested zip {nested_zip['path']}: {str(e)}")
+            # Wait for remaining uploads to complete, propagating any exceptions
+            while pending:
+                _settle(*pending.popleft())
+        except Exception:
+            # Fail fast: drop queued uploads and close the entries opened for them;
+            # running ones finish before the zip closes
+            for fut, task in pending:
+                if task is not None and fut.cancel():
+                    _close_streams(task)
+            for nested_zip in nested_zips:
+                nested_zip['spool'].add_done_callback(_close_spool)
+            raise
         finally:
-            # Cleanup temp file
+            # Workers read entries from zf, so wait for them before it closes
+            wait([fut for fut, _ in pending] + [n['spool'] for n in nested_zips])
+            if tar_spool is not None:
+                tar_spool.close()
+
+    return files_uploaded, files_packed, nested_zips, nested_zips_skipped
+
+
+def _settle(fut, task):
+    # Uploads raise their failure here; a nested zip spool (task None) is only
+    # waited for, and its failure is reported when the worklist reaches it
+    if task is None:
+        wait([fut])
+    else:
+        fut.result()
+
+
+def _close_spool(fut):
+    # Release a buffered nested zip that will never be processed
+    if not fut.cancelled() and fut.exception() is None:
+        fut.result().close()
+
+
+def _extract_and_upload(source, bucket: str, dest_prefix: str, max_depth: int = 10, executor: Optional[ThreadPoolExecutor] = None):
+    """Extract all non-directory entries from a zip archive and upload them to COS.
+    Processes any zip files found within the archive, breadth-first.
+
+    Args:
+        source: Path to the downloaded zip in /tmp, or a seekable file-like object
+            holding the archive (small source zips and nested zips).
+        bucket: Full COS bucket name (e.g., "mybucket-123456789").
+        dest_prefix: Prefix in COS under which extracted files will be placed.
+        max_depth: Maximum nesting depth to prevent infinite loops (default: 10).
+        executor: Worker pool shared by every nesting level (default: the module pool).
+
+    Behavior:
+        - Skips unsafe paths to prevent Zip Slip.
+        - Uses robust directory detection to avoid uploading folder placeholders.
+        - Uploads files in parallel (MAX_WORKERS), keeping at most 2 * MAX_WORKERS
+          uploads in flight so the first failure aborts the archive early.
+        - Sets content type via mimetypes.
+        - Small STORED/DEFLATED entries are read in one shot via _fast_extract; larger
+          ones are read through zipfile, in MULTIPART_PART_SIZE parts when above
+          MULTIPART_THRESHOLD, so only files up to that size are held whole. Either way,
+          decompression happens on the worker threads as they upload.
+        - Walks nested zip files with an iterative worklist up to max_depth levels;
+          they are held in memory up to NESTED_ZIP_MEMORY_MAX bytes across the
+          worklist, and spill to /tmp when larger than SPOOL_MAX_SIZE or over that
+          budget. Nested zips beyond max_depth are skipped and reported.
+        - Optionally packs small files into one tar per zip (PACK_SMALL_FILES_UNDER).
+        - Optionally copies duplicate files server-side (DEDUPE_IDENTICAL_FILES).
+        - Does NOT upload zip files themselves - only extracts and uploads their contents.
+
+    Returns:
+        dict: Summary with counts of processed files and nested zips.
+    """
+    if max_depth <= 0:
+        return {'files_uploaded': 0, 'files_packed': 0, 'nested_zips_processed': 0, 'max_depth_reached': True}
+    
+    executor = executor or _EXECUTOR
+    files_uploaded = 0
+    files_packed = 0
+    nested_zips_processed = 0
+    max_depth_reached = False
+    canonical = {}
+
+    # None of the objects created here are cyclic, so optionally keep the cyclic
+    # GC from pausing the producer mid-archive and collect once at the end
+    gc_paused = DISABLE_GC and gc.isenabled()
+    if gc_paused:
+        gc.disable()
+    try:
+        # Worklist of (name, source, dest_prefix, depth, held); the outer zip is depth 0
+        # and nested zips are queued as futures for their buffered copy, holding held
+        # bytes of memory until they are closed
+        work = deque([(None, source, dest_prefix, 0, 0)])
+        memory_held = 0
+        while work:
+            name, level_source, level_prefix, depth, held = work.popleft()
+            if depth:
+                try:
+                    level_source = level_source.result()
+                except Exception as e:
+                    print(f"Error processing nested zip {name}: {str(e)}")
+                    memory_held -= held
+                    continue
             try:
-                os.remove(nested_zip['path'])
-            except Exception:
-                pass
+                uploaded, packed, nested_zips, skipped = _extract_zip(
+                    level_source, bucket, level_prefix, executor, depth + 1 < max_depth, canonical,
+                    NESTED_ZIP_MEMORY_MAX - memory_held
+                )
+                files_uploaded += uploaded
+                files_packed += packed
+                if depth:
+                    nested_zips_processed += 1
+                if skipped:
+                    max_depth_reached = True
+                for n in nested_zips:
+                    memory_held += n['held']
+                    work.append((n['name'], n['spool'], n['dest_prefix'], depth + 1, n['held']))
+            except Exception as e:
+                if not depth:
+                    raise
+                # Log error but continue processing other nested zips
+                print(f"Error processing nested zip {name}: {str(e)}")
+            finally:
+                if depth:
+                    level_source.close()
+                    memory_held -= held
+    finally:
+        if gc_paused:
+            gc.enable()
+            gc.collect()
     
     return {
         'files_uploaded': files_uploaded,
+        'files_packed': files_packed,
         'nested_zips_processed': nested_zips_processed,
-        'max_depth_reached': max_depth <= 1 and len(nested_zips) > 0
+        'max_depth_reached': max_depth_reached
     }
 
 
+def _iter_keys(records, cos_bucket: str):
+    """Yield (raw, normalized) object keys from COS event records, one at a time.
+
+    Keys are fully URL-decoded; a leading "/<appid>/<bucket>/" is stripped when it
+    names cos_bucket (with or without its appid suffix), as is a leading slash.
+    """
+    from urllib.parse import unquote_plus
+
+    bucket_short = cos_bucket.split('-')[0] if cos_bucket else ''
+    for rec in records:
+        cos_obj = rec.get('cos', {}).get('cosObject', {})
+        raw = unquote_plus(cos_obj.get('key', '') or '')
+        key = raw.lstrip('/')
+        if key[:1].isdigit():
+            parts = key.split('/', 2)
+            if len(parts) == 3 and parts[0].isdigit() and cos_bucket and parts[1] in (cos_bucket, bucket_short):
+                key = parts[2]
+        yield raw, key
+
+
+def _is_zip_candidate(key: str) -> bool:
+    # Skip folder markers and files in the output prefix (prevents infinite loops)
+    if not key or key.endswith('/'):
+        return False
+    if OUTPUT_PREFIX and key.startswith(OUTPUT_PREFIX):
+        return False
+    return key.lower().endswith('.zip') and (not INPUT_PREFIX or key.startswith(INPUT_PREFIX))
+
+
 def main_handler(event, context):
     """SCF entrypoint triggered by COS PutObject events.
 
@@ -252,7 +772,7 @@ def main_handler(event, context):
         - Decode and normalize keys; skip folder markers.
         - Pick first .zip under INPUT_PREFIX.
         - Infer full bucket name if event includes short form.
-        - Download zip to /tmp, extract and upload entries to OUTPUT_PREFIX/<zip base>/.
+        - Download zip into memory (or /tmp when large), extract and upload entries to OUTPUT_PREFIX/<zip base>/.
         - Cleanup temp files and return structured result.
     """
     # Event is COS PutObject trigger
@@ -262,44 +782,17 @@ def main_handler(event, context):
         if not records:
             return {'status': 'ignored', 'reason': 'no records'}
 
-        from urllib.parse import unquote_plus
-
-        cos_bucket = None
-        zip_key = None
-        seen_keys = []
-        for rec in records:
-            cos_info = rec.get('cos', {})
-            cos_bucket = cos_bucket or cos_info.get('cosBucket', {}).get('name') or COS_BUCKET
-            cos_obj = cos_info.get('cosObject', {})
-            # Fully URL-decode key
-            key = unquote_plus(cos_obj.get('key', '') or '')
-            raw_key = key
-            # Normalize possible leading "/appid/bucket/" segments and leading slash
-            key = key.lstrip('/')
-            parts = key.split('/')
-            if len(parts) >= 3 and parts[0].isdigit():
-                # Check if parts[1] matches the bucket name (with or without appid suffix)
-                bucket_name = cos_bucket or ''
-                # Try exact match first, then try bucket short name (before '-')
-                if parts[1] == bucket_name or (bucket_name and parts[1] == bucket_name.split('-')[0]):
-                    key = '/'.join(parts[2:])
-
-            seen_keys.append({'raw': raw_key, 'normalized': key})
-
-            # Skip folder marker events
-            if not key or key.endswith('/'):
-                continue
-            # Skip files in output prefix to prevent infinite loops
-            if OUTPUT_PREFIX and key.startswith(OUTPUT_PREFIX):
-                continue
-            # Find first zip in expected prefix
-            if key.lower().endswith('.zip') and (not INPUT_PREFIX or key.startswith(INPUT_PREFIX)):
-                zip_key = key
-                break
+        # Bucket from the first record, else COS_BUCKET, else any record naming one
+        bucket_names = (rec.get('cos', {}).get('cosBucket', {}).get('name') for rec in records)
+        cos_bucket = next(bucket_names, None) or COS_BUCKET or next(filter(None, bucket_names), None)
+
+        # Stop at the first zip; key diagnostics are only collected when nothing matched
+        zip_key = next((key for _, key in _iter_keys(records, cos_bucket) if _is_zip_candidate(key)), None)
 
         if not cos_bucket:
             return {'status': 'error', 'message': 'COS_BUCKET not set and not found in event'}
         if not zip_key:
+            seen_keys = [{'raw': raw, 'normalized': key} for raw, key in _iter_keys(records, cos_bucket)]
             return {'status': 'ignored', 'reason': 'no zip in records', 'keys': seen_keys, 'bucket': cos_bucket, 'input_prefix': INPUT_PREFIX}
 
         # Determine output base path: OUTPUT_PREFIX/<zip_basename_without_ext>/
@@ -309,30 +802,33 @@ def main_handler(event, context):
 
         # Recover full bucket name <bucketname>-<appid> if event provided short name
         bucket_to_use = cos_bucket
-        if bucket_to_use and '-' not in bucket_to_use:
-            # Try to infer from seen keys like "/<appid>/<bucketname>/..."
-            for k in seen_keys:
-                raw = k.get('raw') or ''
+        if COS_BUCKET and '-' in COS_BUCKET:
+            # Env COS_BUCKET in full form takes precedence
+            bucket_to_use = COS_BUCKET
+        elif '-' not in bucket_to_use:
+            # Try to infer from raw keys like "/<appid>/<bucketname>/..."
+            for raw, _ in _iter_keys(records, cos_bucket):
                 if raw.startswith('/'):
                     parts = raw.strip('/').split('/')
                     if len(parts) >= 2 and parts[0].isdigit() and parts[1] == bucket_to_use:
                         bucket_to_use = f"{parts[1]}-{parts[0]}"
                         break
-        # Fallback to env COS_BUCKET if provided in full form
-        if COS_BUCKET and '-' in COS_BUCKET:
-            bucket_to_use = COS_BUCKET
 
-        # Ensure tmp paths
+        # Ensure tmp paths (only used when the zip is too large to keep in memory)
         tmp_zip = f"/tmp/{zip_name}.zip"
 
-        _download_to_tmp(bucket_to_use, zip_key, tmp_zip)
-        extraction_result = _extract_and_upload(tmp_zip, bucket_to_use, dest_prefix, MAX_RECURSION_DEPTH)
+        # Event is worth processing: load the SDK and build the client on this thread
+        # before any worker needs it (once per container)
+        _get_client()
+        source = _download_to_buffer(bucket_to_use, zip_key, tmp_zip, _EXECUTOR)
+        extraction_result = _extract_and_upload(source, bucket_to_use, dest_prefix, MAX_RECURSION_DEPTH, _EXECUTOR)
 
         # Optional: cleanup tmp file
-        try:
-            os.remove(tmp_zip)
-        except Exception:
-            pass
+        if isinstance(source, str):
+            try:
+                os.remove(source)
+            except Exception:
+                pass
 
         return {  # Return structured result
             'status': 'ok',
@@ -340,6 +836,7 @@ def main_handler(event, context):
             'source_key': zip_key,
             'output_prefix': dest_prefix,
             'files_uploaded': extraction_result.get('files_uploaded', 0),
+            'files_packed': extraction_result.get('files_packed', 0),
             'nested_zips_processed': extraction_result.get('nested_zips_processed', 0),
             'max_depth_reached': extraction_result.get('max_depth_reached', False),
         }